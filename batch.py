@@ -0,0 +1,260 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from geopy.geocoders import Nominatim
+import csv
+import json
+import os
+import threading
+import time
+
+from hikingproject import HikingProject
+
+
+summary_fields = ["name", "location", "lat", "lon", "distance", "triplength",
+                  "status", "length", "paths", "seconds", "output", "error"]
+
+
+def check_job(row):
+    """
+    Returns the job for one row of a job file.  A row that can't be planned
+    is returned with an "error" rather than raising, so it is recorded as
+    failed without stopping the other jobs
+    """
+    if not isinstance(row, dict):
+        return {"error": "Invalid job %s: a job must be an object" % str(row)}
+
+    job = dict(row)
+    try:
+        if not job.get("location"):
+            raise Exception("The job has no location")
+        job["distance"]   = float(job.get("distance", 10))
+        job["triplength"] = float(job.get("triplength", 30))
+        job["mindist"]    = float(job.get("mindist", 0))
+        if job.get("time_limit"):
+            job["time_limit"] = float(job["time_limit"])
+    except (ValueError, TypeError) as e:
+        job["error"] = "Invalid job %s: %s" % (str(row), str(e))
+    except Exception as e:
+        job["error"] = str(e)
+    return job
+
+
+def read_jobs(filename):
+    """
+    Reads a job file of trips to plan.  A .jsonl file has one JSON object per
+    line, any other file is read as CSV with a header row.  Each job has a
+    "location", and optionally "distance" (miles), "triplength" (km),
+    "mindist" (km), "time_limit" (seconds) and "name" for the output file.
+    Jobs without a name are named after their location, plus their row number
+    if that name is already taken.  A repeated name is an error for the later job
+    """
+    rows = []
+    with open(filename, 'r') as f:
+        if filename.endswith(".jsonl"):
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    rows.append({"error": "Invalid JSON line %s: %s" % (line.strip(), str(e))})
+                    continue
+                if not isinstance(row, dict):
+                    row = {"error": "Invalid job %s: a job must be an object" % line.strip()}
+                rows.append(row)
+        else:
+            for row in csv.DictReader(f):
+                rows.append(dict([(key, value) for key, value in row.items() if value]))
+
+    jobs  = []
+    names = set()
+    for i, row in enumerate(rows):
+        job  = row if "error" in row else check_job(row)
+        name = job.get("name")
+        if name is None:
+            name = str(job.get("location", "job"))
+            if name in names:
+                name = "%s_%i" % (name, i+1)
+        elif name in names:
+            job["error"] = "Duplicate job name %s" % name
+        job["name"] = name
+        if "error" not in job:
+            names.add(name)
+        jobs.append(job)
+
+    return jobs
+
+
+class GeocodeCache():
+    def __init__(self, filename="geocode_cache.json"):
+        """
+        Geocodes locations through one shared geolocator, and keeps the results
+        in [filename] so a location is only looked up once across batches
+        """
+        self.filename   = filename
+        self.geolocator = Nominatim(user_agent="testing app")
+        self.locations  = {}
+
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.locations = json.load(f)
+
+    def lookup(self, location):
+        from mapper import LocationName
+        if location not in self.locations:
+            self.locations[location] = LocationName(location, self.geolocator)
+            # Nominatim allows one request a second
+            time.sleep(1)
+        return tuple(self.locations[location])
+
+    def save(self):
+        with open(self.filename, 'w+') as f:
+            json.dump(self.locations, f)
+
+
+def plan_job(job, directory, output):
+    """
+    Builds the trail network for a downloaded job and plans its trip.
+    Runs in a worker process, so it imports the mapper there
+    """
+    from mapper import TripPlanner, create_trip, save_gpx
+    from ortools.linear_solver import pywraplp
+
+    start = time.time()
+    trip  = TripPlanner(directory)
+    trip.create_network()
+    opt   = create_trip(trip, maxdist=job["triplength"], mindist=job["mindist"],
+                        time_limit=job.get("time_limit"))
+    if opt.status not in [pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE]:
+        raise Exception("No trip was found (solver status %i)" % opt.status)
+    # With no minimum distance, an empty trip is always a solution
+    if not opt.get_trip():
+        raise Exception("No trip was found within %s km" % str(job["triplength"]))
+    save_gpx(opt, output)
+
+    return {"length":  opt.objective.Value(),
+            "paths":   len(opt.results),
+            "seconds": round(time.time() - start, 1)}
+
+
+class BatchPlanner():
+    def __init__(self, jobs, workers=4, downloads=4, directory=os.getcwd(),
+                 output_dir=os.getcwd()+"/saved_trips"):
+        """
+        Plans a trip for every job.  Geocoding and downloads share one
+        geolocator and one HikingProject login, and run on [downloads] threads.
+        Networks are built and solved on a pool of [workers] processes, which
+        caps how many jobs are solved at once.  A job that fails is recorded in
+        the summary and does not stop the others.
+        """
+        self.jobs       = jobs
+        self.workers    = workers
+        self.downloads  = downloads
+        self.directory  = directory
+        self.output_dir = output_dir
+        self.geocoder   = GeocodeCache()
+        self.session    = None
+        self.summary    = []
+        self.lock       = threading.Lock()
+
+    def download(self, location, distance, coords):
+        # The planner loads every file in a folder, so each distance gets its own
+        folder = self.directory+"/%s/%gmi" % (location, distance)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        HPDL = HikingProject(lat=coords[0], lon=coords[1], maxdistance=distance, session=self.session)
+        HPDL.download_trails(directory=folder)
+        return folder
+
+    def record(self, job, coords, status, result=None, error=None):
+        row = dict([(field, "") for field in summary_fields])
+        row.update({"name":       job.get("name", ""),
+                    "location":   job.get("location", ""),
+                    "distance":   job.get("distance", ""),
+                    "triplength": job.get("triplength", ""),
+                    "status":     status,
+                    "output":     self.output_path(job) if status == "ok" else ""})
+        if coords:
+            row["lat"], row["lon"] = coords
+        if result:
+            row.update(result)
+        if error:
+            row["error"] = str(error)
+        print("%s: %s" % (row["name"], status))
+        with self.lock:
+            self.summary.append(row)
+
+    def output_path(self, job):
+        return self.output_dir+"/%s.gpx" % job["name"]
+
+    def run(self):
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        self.session = HikingProject.open_session()
+
+        solving = []
+        with ProcessPoolExecutor(max_workers=self.workers) as solvers, \
+             ThreadPoolExecutor(max_workers=self.downloads) as downloaders:
+
+            pending   = []
+            downloads = {}
+            for job in self.jobs:
+                if "error" in job:
+                    self.record(job, None, "failed", error=job["error"])
+                    continue
+                location = job["location"]
+                try:
+                    coords = self.geocoder.lookup(location)
+                except Exception as e:
+                    self.record(job, None, "failed", error=e)
+                    continue
+                # Jobs for the same location and distance share one download
+                region = (location, job["distance"])
+                if region not in downloads:
+                    downloads[region] = downloaders.submit(self.download, location, job["distance"], coords)
+                pending.append((job, coords, downloads[region]))
+            self.geocoder.save()
+
+            # Jobs are handed to the solvers in order while later downloads continue
+            for job, coords, download in pending:
+                try:
+                    folder = download.result()
+                except Exception as e:
+                    self.record(job, coords, "failed", error=e)
+                    continue
+                solving.append((job, coords, solvers.submit(plan_job, job, folder, self.output_path(job))))
+
+            for job, coords, solve in solving:
+                try:
+                    self.record(job, coords, "ok", result=solve.result())
+                except Exception as e:
+                    self.record(job, coords, "failed", error=e)
+
+        return self.summary
+
+    def save_summary(self, filename):
+        with open(filename, 'w+', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=summary_fields)
+            writer.writeheader()
+            for row in self.summary:
+                writer.writerow(row)
+
+
+def setup_argparser():
+    import argparse
+    parser = argparse.ArgumentParser(description='Plan Backpacking Trips for a file of locations')
+    parser.add_argument('jobs', help="a CSV or JSONL file with a location, distance and triplength per job")
+    parser.add_argument('-workers', help="the number of trips solved at once", type=int, default=os.cpu_count())
+    parser.add_argument('-downloads', help="the number of regions downloaded at once", type=int, default=4)
+    parser.add_argument('-output', help="the folder for the trip GPX files and summary", default=os.getcwd()+"/saved_trips")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args    = setup_argparser()
+    jobs    = read_jobs(args.jobs)
+    planner = BatchPlanner(jobs, workers=args.workers, downloads=args.downloads, output_dir=args.output)
+    planner.run()
+    planner.save_summary(args.output+"/summary.csv")
+    print("%i of %i trips planned" % (len([row for row in planner.summary if row["status"] == "ok"]), len(jobs)))
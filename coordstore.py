@@ -0,0 +1,149 @@
+from shapely.geometry import LineString, MultiLineString
+import networkx as nx
+import numpy as np
+import json
+import os
+import threading
+
+
+class CoordinateStore():
+    def __init__(self, directory):
+        """
+        Columnar store of every vertex in a region.  All coordinates live in a
+        single float64 file of (lon, lat) rows, which is memory-mapped read only.
+        Offset arrays split the rows into lines, and the lines into shapes (one
+        shape per track and per path).  Processes that open the same store share
+        its geometry through the page cache.
+
+        Files in [directory]:
+            coords.f64  - every vertex, (lon, lat) float64 rows
+            lines.npy   - row offset where each line starts (plus the end)
+            shapes.npy  - line offset where each shape starts (plus the end)
+            multi.npy   - whether each shape is a MultiLineString
+            index.json  - the track and path that owns each shape
+        """
+        self.directory = directory
+
+        coord_file = os.path.join(directory, "coords.f64")
+        if os.path.getsize(coord_file):
+            self.coords = np.memmap(coord_file, dtype=np.float64, mode='r').reshape(-1, 2)
+        else:
+            # An empty file can not be memory-mapped
+            self.coords = np.zeros((0, 2))
+        self.lines  = np.load(os.path.join(directory, "lines.npy"), mmap_mode='r')
+        self.shapes = np.load(os.path.join(directory, "shapes.npy"), mmap_mode='r')
+        self.multi  = np.load(os.path.join(directory, "multi.npy"), mmap_mode='r')
+
+        with open(os.path.join(directory, "index.json"), 'r') as f:
+            self.index = json.load(f)
+
+    @classmethod
+    def write(cls, directory, trip):
+        """
+        Writes the geometry of every track in [trip] and every path on those
+        tracks to a new store in [directory], and returns the opened store
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        coords  = []
+        lines   = [0]
+        shapes  = [0]
+        multi   = []
+        index   = {"tracks": [], "paths": []}
+
+        def add_shape(geometry):
+            if geometry.type == 'LineString':
+                parts = [geometry]
+            else:
+                parts = list(geometry)
+            for line in parts:
+                line_coords = np.asarray(line.coords, dtype=np.float64)[:, :2]
+                coords.append(line_coords)
+                lines.append(lines[-1] + len(line_coords))
+            shapes.append(len(lines) - 1)
+            multi.append(geometry.type != 'LineString')
+            return len(multi) - 1
+
+        for track in trip.tracks.values():
+            index["tracks"].append([track.name, track.filename, add_shape(track.track)])
+            for path in track.paths.values():
+                index["paths"].append([path.name, list(path.origin), list(path.destination),
+                                       path.distance, add_shape(path.points)])
+
+        # Each file is written aside and renamed into place, so a process that
+        # still has an older copy mapped keeps reading the old file.  The temporary
+        # names are unique to this writer, so two writers never share a file
+        suffix = ".%i.%i.tmp" % (os.getpid(), threading.get_ident())
+        def target(name):
+            return os.path.join(directory, name + suffix)
+
+        with open(target("coords.f64"), 'wb') as f:
+            if coords:
+                np.concatenate(coords).tofile(f)
+        with open(target("lines.npy"), 'wb') as f:
+            np.save(f, np.array(lines, dtype=np.int64))
+        with open(target("shapes.npy"), 'wb') as f:
+            np.save(f, np.array(shapes, dtype=np.int64))
+        with open(target("multi.npy"), 'wb') as f:
+            np.save(f, np.array(multi, dtype=bool))
+        with open(target("index.json"), 'w+') as f:
+            json.dump(index, f)
+
+        for name in ["coords.f64", "lines.npy", "shapes.npy", "multi.npy", "index.json"]:
+            os.replace(target(name), os.path.join(directory, name))
+
+        return cls(directory)
+
+    def shape_lines(self, shape):
+        """
+        Returns the lines of a shape as views into the coordinate file -- no copy is made
+        """
+        views = []
+        for i in range(self.shapes[shape], self.shapes[shape+1]):
+            views.append(self.coords[self.lines[i]:self.lines[i+1]])
+        return views
+
+    def geometry(self, shape):
+        """
+        Builds a shapely geometry for a shape.  Shapely copies the vertices, so the
+        geometry is only built when it is asked for, and is not kept
+        """
+        lines = self.shape_lines(shape)
+        if self.multi[shape]:
+            return MultiLineString(lines)
+        return LineString(lines[0])
+
+    def attach(self, trip):
+        """
+        Points every track and path in [trip] at this store, and drops their own
+        copies of the geometry
+        """
+        track_shapes = dict([(name, shape) for name, filename, shape in self.index["tracks"]])
+        path_shapes  = {}
+        for name, origin, destination, distance, shape in self.index["paths"]:
+            path_shapes[(tuple(origin), tuple(destination), name)] = shape
+
+        for track in trip.tracks.values():
+            track.use_store(self, track_shapes[track.name])
+            for path in track.paths.values():
+                path.use_store(self, path_shapes[(path.origin, path.destination, path.name)])
+
+    def load_paths(self, path_object):
+        """
+        Registers every path in the store with [path_object] (the Path class),
+        without parsing any GPX files
+        """
+        paths = []
+        for name, origin, destination, distance, shape in self.index["paths"]:
+            paths.append(path_object.from_store(self, shape, name, tuple(origin), tuple(destination), distance))
+        return paths
+
+    def network(self):
+        """
+        Rebuilds the trail network for the region from the store
+        """
+        trail_network = nx.Graph()
+        for name, origin, destination, distance, shape in self.index["paths"]:
+            trail_network.add_edge(tuple(origin), tuple(destination), length=distance, name=name)
+        return trail_network
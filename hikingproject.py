@@ -17,12 +17,17 @@ API_key   = config['HikingProject.com']['API_key']
 
 
 class HikingProject():
-    def __init__(self, lat=40.0274, lon=-105.2519, maxdistance=50):
-        self.session_requests = None
+    def __init__(self, lat=40.0274, lon=-105.2519, maxdistance=50, session=None):
+        """
+        [session] is an already logged in session, so many downloads
+        can share one login
+        """
+        self.session_requests = session
         self.trails = None
         
         self.get_trail_list(key = API_key, lat=lat, lon=lon, maxdistance=maxdistance)
-        self.login(email, password)
+        if self.session_requests is None:
+            self.login(email, password)
 
     @classmethod
     def get_gps_from_location(cls, location):
@@ -38,7 +43,9 @@ class HikingProject():
                     "lon":lon,
                     "maxResults":500, 
                     "maxDistance":maxdistance}
-        r = requests.get('https://www.hikingproject.com/data/get-trails', params = payload)
+        # Reuse a shared session's connection when there is one
+        http = self.session_requests or requests
+        r = http.get('https://www.hikingproject.com/data/get-trails', params = payload)
         self.trails = r.json()["trails"]
 
     @classmethod    
@@ -52,14 +59,22 @@ class HikingProject():
                 
         
     def download_trails(self, directory = os.getcwd()):
+        for gpxfile in self.iter_downloads(directory):
+            pass
+            
+    def iter_downloads(self, directory = os.getcwd()):
+        """
+        Yields the gpx file for each trail as soon as it is on disk,
+        downloading it first if it is not already in the directory
+        """
         downloaded = HikingProject.get_downloaded(directory)
         for trail in self.trails:
             gpx_id = trail["id"]
+            gpxfile  = directory+"/"+str(gpx_id) + ".gpx"
             
             if str(gpx_id) not in downloaded:
                 url      = "https://www.hikingproject.com/trail/gpx/%s" % str(gpx_id)
                 print("downloading:%s" % url)
-                gpxfile  = directory+"/"+str(gpx_id) + ".gpx"
                 try:
                     data     = self.session_requests.get(url, headers = dict(referer = url), allow_redirects = True)
                 except:
@@ -67,23 +82,34 @@ class HikingProject():
                      
                 with open(gpxfile, 'w+') as f:
                     f.write(data.text)
+            
+            yield gpxfile
                             
     def login(self, email, password):
-        self.session_requests = requests.session()
+        self.session_requests = HikingProject.open_session(email, password)
+        
+    @classmethod
+    def open_session(cls, email=email, password=password):
+        """
+        Logs in to HikingProject and returns the session
+        """
+        session_requests = requests.session()
         
         login_url = "https://www.hikingproject.com/auth/login"
         email_url = "https://www.hikingproject.com/auth/login/email"
-        result = self.session_requests.get(login_url)
+        result = session_requests.get(login_url)
         
         tree = html.fromstring(result.text)
         authenticity_token = list(set(tree.xpath("//input[@name='_token']/@value")))[0]
         
         payload = {"email":email, "pass":password, "_token":authenticity_token}
         
-        result = self.session_requests.post(
+        result = session_requests.post(
             email_url,
             data = payload,
             headers = dict(referer=login_url))
             
         if result.status_code != 200:
-            raise Exception("Unable to Login to HikingProject. Please check login credentials")
\ No newline at end of file
+            raise Exception("Unable to Login to HikingProject. Please check login credentials")
+            
+        return session_requests
\ No newline at end of file
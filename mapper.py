@@ -4,13 +4,16 @@ from hikingproject import HikingProject
 import random
 import requests
 
-from tripopt import RouteOptimizer
+from tripopt import RouteOptimizer, save_results_gpx
+from pipeline import TrackPipeline
 
 from shapely.geometry import MultiLineString, Point
 from shapely import ops
 import fiona
 import itertools
 import networkx as nx
+import numpy as np
+import math
 import os
 
 
@@ -32,6 +35,9 @@ snap_tolerance = 1e-4
 
                   
 class Track():
+    store       = None
+    store_index = None
+    
     def __init__(self, filename):
         self.name             = None
         self.track            = None
@@ -49,6 +55,36 @@ class Track():
         self.points  = feature['geometry']['coordinates']
         self.track   = self.check_track(MultiLineString(self.points))
         self.name    = feature['properties']['name']
+    
+    @property
+    def points(self):
+        if self._points is None and self.store is not None:
+            return self.store.shape_lines(self.store_index)
+        return self._points
+    
+    @points.setter
+    def points(self, value):
+        self._points = value
+    
+    @property
+    def track(self):
+        if self._track is None and self.store is not None:
+            return self.store.geometry(self.store_index)
+        return self._track
+    
+    @track.setter
+    def track(self, value):
+        self._track = value
+    
+    def use_store(self, store, index):
+        """
+        Reads the track geometry from a CoordinateStore rather than keeping
+        a copy. Once attached, points holds the one-way track from check_track
+        """
+        self.store       = store
+        self.store_index = index
+        self._points     = None
+        self._track      = None
         
     def check_track(self, track):
         """
@@ -201,7 +237,10 @@ class Track():
     
 
 class Path():
-    paths = {}
+    paths       = {}
+    store       = None
+    store_index = None
+    
     def __init__(self, name, points, origin, destination):
         self.name         = name
         self.points       = points
@@ -225,6 +264,52 @@ class Path():
         self.__init__(grouping, points, origin, destination)
         return self                  # return the new registered instance           
             
+    @classmethod
+    def from_store(cls, store, index, name, origin, destination, distance):
+        """
+        Registers a path whose geometry is kept in a CoordinateStore
+        """
+        chk = cls.get(cls.make_hash(origin, destination, name))
+        if chk:
+            return chk
+        self = object.__new__(cls)
+        self.name         = name
+        self.origin       = origin
+        self.destination  = destination
+        self.distance     = distance
+        self.original_key = (origin, destination, name)
+        self.reverse_key  = (destination, origin, name)
+        self.db_hash      = self.make_hash(origin, destination, name)
+        self.use_store(store, index)
+        cls.paths[self.db_hash] = self
+        return self
+    
+    @property
+    def points(self):
+        if self._points is None and self.store is not None:
+            return self.store.geometry(self.store_index)
+        return self._points
+    
+    @points.setter
+    def points(self, value):
+        self._points = value
+    
+    def use_store(self, store, index):
+        """
+        Reads the path geometry from a CoordinateStore rather than keeping a copy
+        """
+        self.store       = store
+        self.store_index = index
+        self._points     = None
+    
+    def coords(self):
+        """
+        The path's lines as views into its CoordinateStore
+        """
+        if self.store is None:
+            raise Exception("Path %s is not in a CoordinateStore" % self.name)
+        return self.store.shape_lines(self.store_index)
+    
     @classmethod
     def list_paths(cls):
         return cls.paths
@@ -276,25 +361,47 @@ class Path():
         return self.distance
         
         
+class PathLookup():
+    def __init__(self, trip):
+        """
+        Looks up the paths of a single trip, with the same .get() as the
+        Path class.  The Path registry is shared by every trip in the process,
+        so a trip that outlives others uses this to find its own paths
+        """
+        self.paths = {}
+        for path in trip.iter_paths():
+            self.paths[path.db_hash] = path
+    
+    def get(self, db_hash):
+        hash_value = Path.make_hash(db_hash[0], db_hash[1], db_hash[2])
+        return self.paths.get(hash_value, False)
+        
+        
 def find_roads():
     """ Find nearest road to track """
     pass
 
 class TripPlanner():
-    def __init__(self, location=""):
+    def __init__(self, location="", load=True):
         """
         Will setup a new trip for a specific location.
         The trip will load all tracks, connect them together, and generate
         the path and trail network for optimization.
+        With load=False the trip starts empty and tracks are added one at a
+        time with add_track()
         """
         self.tracks        = {}
         self.nodes         = []
         self.location      = location
-        self.file_list     = HikingProject.get_downloaded(directory=location)
+        self.file_list     = []
         self.trail_network = nx.Graph()
+        self.node_index    = None
+        self.path_trees    = {}
 
-        self.load_all_tracks()
-        self.connect_tracks()
+        if load:
+            self.file_list = HikingProject.get_downloaded(directory=location)
+            self.load_all_tracks()
+            self.connect_tracks()
 
     
     def load_all_tracks(self):
@@ -302,20 +409,43 @@ class TripPlanner():
             return self.tracks
             
         for gpxfile in self.file_list:
-            try:
-                fname = self.location+"/"+str(gpxfile)+".gpx"
-                gpxtrack = Track(fname)
+            fname    = self.location+"/"+str(gpxfile)+".gpx"
+            gpxtrack = self.load_track(fname)
+            if gpxtrack:
                 self.tracks[gpxtrack.name] = gpxtrack
-            except Exception as e:
-                if type(e) == fiona.errors.DriverError:
-                    print("%s is not a valid GPX track" % fname)
-                    continue
-                else:
-                    print(e)
-                    raise Exception("Could not load track %s" % fname)        
     
         return self.tracks
 
+    @classmethod
+    def load_track(cls, fname):
+        """
+        Parses a single GPX file.  Returns None if the file is not a valid GPX track
+        """
+        try:
+            return Track(fname)
+        except Exception as e:
+            if type(e) == fiona.errors.DriverError:
+                print("%s is not a valid GPX track" % fname)
+                return None
+            else:
+                print(e)
+                raise Exception("Could not load track %s" % fname)        
+
+    def add_track(self, track):
+        """
+        Joins a newly loaded track against the tracks already in the trip,
+        then adds it to the trip
+        """
+        if track.name in self.tracks:
+            print("Skipping duplicate track %s" % track.name)
+            return False
+            
+        for line1 in self.tracks.values():
+            line1.track_intersection(track)
+            
+        self.tracks[track.name] = track
+        self.file_list.append(os.path.basename(track.filename).split(".gpx")[0])
+        return track
             
     def connect_tracks(self):
         """
@@ -350,9 +480,105 @@ class TripPlanner():
                 self.trail_network.add_node(path.origin)
                 self.trail_network.add_node(path.destination)
                 self.trail_network.add_edge(path.origin, path.destination, length=path.distance, name=key) 
+        
+        # The network changed, so node lookups and shortest paths are stale
+        self.node_index = None
+        self.path_trees = {}
                
             
         pass 
+    def nearest_node(self, trailhead):
+        """
+        Snaps a (latitude, longitude) trailhead to the nearest node in the
+        trail network.  Node coordinates are kept in one array, so a lookup
+        is a single vectorised pass rather than a loop over nodes
+        """
+        if self.node_index is None:
+            nodes           = list(self.trail_network.nodes())
+            self.node_index = (nodes, np.array([node[:2] for node in nodes]))
+        nodes, coords = self.node_index
+        if not nodes:
+            raise Exception("The trail network has no nodes. Run create_network first")
+        
+        lat, lon = trailhead
+        # Longitude degrees shrink with latitude
+        scale    = math.cos(math.radians(lat))
+        dist     = ((coords[:, 0] - lon)*scale)**2 + (coords[:, 1] - lat)**2
+        return nodes[int(np.argmin(dist))]
+    
+    def shortest_paths(self, start, cutoff):
+        """
+        Returns the trail distance (km) from [start] to every node within
+        [cutoff] km.  Shortest path trees are cached by start node, and a
+        tree built for a longer cutoff serves shorter ones
+        """
+        cached = self.path_trees.get(start)
+        if cached is None or cached[0] < cutoff:
+            tree   = nx.single_source_dijkstra_path_length(self.trail_network, start, cutoff=cutoff, weight="length")
+            cached = self.path_trees[start] = (cutoff, tree)
+        
+        if cached[0] == cutoff:
+            return cached[1]
+        return dict([(node, dist) for node, dist in cached[1].items() if dist <= cutoff])
+    
+    def reachable_network(self, start, maxdist):
+        """
+        Returns the part of the trail network a trip of up to [maxdist] km
+        from [start] can use.  A path from u to v can only be on such a trip if
+        start->u, the path, and v->start add up to no more than [maxdist], so
+        no node more than maxdist/2 from the start is kept
+        """
+        dist    = self.shortest_paths(start, maxdist/2)
+        network = nx.Graph()
+        for origin, destination, data in self.trail_network.edges(data=True):
+            if origin not in dist or destination not in dist:
+                continue
+            if dist[origin] + data["length"] + dist[destination] <= maxdist:
+                network.add_edge(origin, destination, **data)
+        
+        if start not in network:
+            raise Exception("No trip of %s km can be made from the trailhead at %s" % (str(maxdist), str(start)))
+        return network
+    
+    def compact(self, directory=None):
+        """
+        Moves the geometry of every track and path into a memory-mapped
+        CoordinateStore (in [directory], by default a .coords folder in the
+        trip's location) and returns the store.  Trips that share a location
+        folder need a [directory] each
+        """
+        from coordstore import CoordinateStore
+        if directory is None:
+            directory = self.location+"/.coords"
+        store = CoordinateStore.write(directory, self)
+        store.attach(self)
+        return store
+    
+    def iter_paths(self):
+        """
+        Yields every path on the trip's tracks
+        """
+        for track in self.tracks.values():
+            for path in track.paths.values():
+                yield path
+    
+    def path_lookup(self):
+        """
+        Returns a PathLookup of this trip's own paths
+        """
+        return PathLookup(self)
+    
+    def release(self):
+        """
+        Removes this trip's paths from the shared Path registry so a
+        long-running process can drop a region without leaking its geometry.
+        Paths are shared between overlapping trips, so trips that are still in
+        use should look their paths up with path_lookup() rather than Path
+        """
+        for path in list(self.iter_paths()):
+            if Path.paths.get(path.db_hash) is path:
+                del Path.paths[path.db_hash]
+        
     def add_paths(self):
         """
         Creates a simplified, relational path network for the LP problem
@@ -367,8 +593,9 @@ class TripPlanner():
 
 
         
-def LocationName(location):
-    geolocator = Nominatim(user_agent="testing app")
+def LocationName(location, geolocator=None):
+    if geolocator is None:
+        geolocator = Nominatim(user_agent="testing app")
     try:
         location = geolocator.geocode(location)
     except:
@@ -382,6 +609,15 @@ def setup_argparser():
                         help='the location to generate combined trails for', nargs='+')
     parser.add_argument('-distance', help="the distance from the location to collect trails", type=int)
     parser.add_argument('-triplength', help="the length of the trip in km", type=int)
+    parser.add_argument('-trailhead', help="the latitude and longitude the trip has to start from", nargs=2, type=float)
+    parser.add_argument('-tiled', help="build the trail network in tiles of this many km, for very large areas", type=float)
+    parser.add_argument('-solvetiles', help="with -tiled, plan the best trip within each tile instead of across all tiles", action='store_true')
+    parser.add_argument('-alternatives', help="the number of distinct trips to plan", type=int, default=1)
+    parser.add_argument('-dissimilarity', help="the share of trail segments each alternative trip must not share with the others", type=float, default=0.2)
+    parser.add_argument('-serve', help="run as a trip planning service instead of planning a single trip", action='store_true')
+    parser.add_argument('-port', help="the port the trip planning service listens on", type=int, default=8080)
+    parser.add_argument('-workers', help="the number of trip requests the service handles at once", type=int, default=4)
+    parser.add_argument('-cachesize', help="the memory in MB the service may use to keep regions warm", type=int, default=1024)
     args = parser.parse_args()
     return args
 
@@ -390,21 +626,57 @@ def setup_trips(location):
     trip.create_network()
     return trip
 
-def create_trip(trip_db, maxdist=30):
-    opt = RouteOptimizer(trip_db.trail_network, maxdist=maxdist)
+def create_trip(trip_db, maxdist=30, mindist=0, time_limit=None):
+    opt = RouteOptimizer(trip_db.trail_network, mindist=mindist, maxdist=maxdist)
     opt.setup_lp()
     opt.set_grouping_constraint(1)
-    opt.solve()
+    opt.solve(time_limit)
     return opt
+
+def setup_trailhead_trip(trip_db, trailhead, maxdist=30, mindist=0):
+    """
+    Sets up (without solving) a trip that starts from the trail network node
+    nearest to the (latitude, longitude) [trailhead].  Only the part of the
+    network reachable within [maxdist] is put in the model
+    """
+    start   = trip_db.nearest_node(trailhead)
+    network = trip_db.reachable_network(start, maxdist)
+    print("Trailhead at %s: %i of %i trail segments are reachable" % (str(start), network.number_of_edges(), trip_db.trail_network.number_of_edges()))
     
+    opt = RouteOptimizer(network, mindist=mindist, maxdist=maxdist)
+    opt.setup_lp()
+    opt.set_start_node(start)
+    opt.set_grouping_constraint(1)
+    return opt
+
+def create_trailhead_trip(trip_db, trailhead, maxdist=30, mindist=0, time_limit=None):
+    opt = setup_trailhead_trip(trip_db, trailhead, maxdist=maxdist, mindist=mindist)
+    opt.solve(time_limit)
+    return opt
+
+def stream_trips(coords, distance, directory, parsers=2, queue_size=16, session=None):
+    """
+    Downloads, parses and connects every trail within [distance] miles of
+    [coords], and returns a TripPlanner with its network created.
+    [session] is an optional logged in HikingProject session to reuse
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    print("Streaming Trails for:", coords, " within ", distance, "miles")
+    HPDL     = HikingProject(lat=coords[0], lon=coords[1], maxdistance=distance, session=session)
+    trip     = TripPlanner(directory, load=False)
+    pipeline = TrackPipeline(HPDL, trip, parsers=parsers, queue_size=queue_size)
+    pipeline.run()
+    trip.create_network()
+    return trip
+
 def save_gpx(optimized_network, file_location, gpx_type = "optimization"):
     if gpx_type == "optimization":
         optimized_network.save_gpx(Path, file_location)
     
 
-
-if __name__ == '__main__':
-    import os
+def main():
     location = None
     args = setup_argparser()
     distance = args.distance
@@ -412,6 +684,11 @@ if __name__ == '__main__':
     if args.location:
         location = " ".join(args.location)
     
+    if args.serve:
+        from tripserver import serve
+        serve(port=args.port, workers=args.workers, cache_mb=args.cachesize)
+        return
+    
     if not location:
         raise Exception("No location has been provided. Please use the --location argument")
         
@@ -425,22 +702,45 @@ if __name__ == '__main__':
     download_location = os.getcwd() +"/%s" % location
     output_location   = os.getcwd() + "/saved_trips/%s.gpx" % location
     
-    if not os.path.exists(download_location):
-        os.mkdir(download_location)
-    
-    print("Downloading Trails for:", coords, " within ", distance, "miles")
-    HPDL = HikingProject(lat=coords[0],lon=coords[1], maxdistance=distance)
-    HPDL.download_trails(directory = download_location )
-    print("%i trails downloaded" % len(HPDL.trails))
-    
     # Solve nullifying problem: Add another constraints for nodes to restrict total edge count to 2.
     #  No need to remove duplicate tacks
     #   Can investigate option to test duplicate tracks as well
     
-    network = setup_trips(location)
-    trip = create_trip(network, maxdist = length)
-    save_gpx(trip, output_location)
+    if args.tiled:
+        from tiling import TiledTripPlanner
+        if not os.path.exists(download_location):
+            os.mkdir(download_location)
+        HPDL = HikingProject(lat=coords[0],lon=coords[1], maxdistance=distance)
+        HPDL.download_trails(directory = download_location )
+        network = TiledTripPlanner(download_location, tile_km=args.tiled)
+        network.create_network()
+    else:
+        network = stream_trips(coords, distance, download_location)
     
+    if args.tiled and args.solvetiles:
+        trips = network.solve_tiles(maxdist = length)
+        if not trips:
+            raise Exception("No trails were found to plan a trip with")
+        print("Best trip is in tile %i: %s km" % (trips[0][2], trips[0][0]))
+        save_results_gpx(Path, trips[0][1], output_location)
+        return
     
-    
-    
\ No newline at end of file
+    if args.trailhead:
+        trip = create_trailhead_trip(network, args.trailhead, maxdist = length)
+    else:
+        trip = create_trip(network, maxdist = length)
+        
+    if args.alternatives > 1:
+        alternatives = trip.get_alternatives(args.alternatives, args.dissimilarity)
+        for i, (value, results) in enumerate(alternatives):
+            print("Trip %i: %s km" % (i+1, value))
+        trip.save_alternatives(Path, alternatives, output_location)
+    else:
+        save_gpx(trip, output_location)
+
+
+if __name__ == '__main__':
+    # Run from the imported module, so the tiling and service modules (which
+    # import mapper) share its Path registry rather than a second copy of it
+    import mapper
+    mapper.main()
@@ -0,0 +1,128 @@
+from queue import Queue, Empty
+import threading
+
+from hikingproject import HikingProject
+
+
+class TrackPipeline():
+    def __init__(self, downloader, trip, parsers=2, queue_size=16):
+        """
+        Streams a region into [trip], a TripPlanner made with load=False whose
+        location is the download folder.  Each GPX file is parsed and checked as
+        soon as it is downloaded, and each parsed track is joined against the
+        tracks already loaded as it arrives.  The stages run concurrently and are
+        connected by bounded queues of [queue_size], so a slow stage holds back
+        the one before it rather than piling up files in memory.
+
+        Tracks are joined in file order whatever order the parsers finish in,
+        so a region always gives the same network.
+
+        [downloader] is a HikingProject with its trail list already fetched
+        """
+        self.downloader = downloader
+        self.trip       = trip
+        self.directory  = trip.location
+        self.parsers    = parsers
+        self.downloaded = Queue(maxsize=queue_size)
+        self.parsed     = Queue(maxsize=queue_size)
+        self.errors     = []
+        self.stop       = threading.Event()
+
+    def gpx_files(self):
+        """
+        GPX files already in the directory that are not part of the trail list are
+        loaded too, as TripPlanner would.  They are available straight away, so go first
+        """
+        trail_ids = set([str(trail["id"]) for trail in self.downloader.trails])
+        for gpx_id in HikingProject.get_downloaded(self.directory):
+            if gpx_id not in trail_ids:
+                yield self.directory+"/"+gpx_id+".gpx"
+
+        for gpxfile in self.downloader.iter_downloads(self.directory):
+            yield gpxfile
+
+    def download_stage(self):
+        try:
+            for i, gpxfile in enumerate(self.gpx_files()):
+                if self.stop.is_set():
+                    break
+                self.downloaded.put((i, gpxfile))
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            # One stop marker for each parser
+            for i in range(self.parsers):
+                self.downloaded.put(None)
+
+    def parse_stage(self):
+        try:
+            while True:
+                try:
+                    item = self.downloaded.get(timeout=0.1)
+                except Empty:
+                    if self.stop.is_set():
+                        break
+                    continue
+                if item is None:
+                    break
+                if self.stop.is_set():
+                    continue
+                i, gpxfile = item
+                # Invalid files are passed on as None, so the joining order has no gaps
+                self.parsed.put((i, self.trip.load_track(gpxfile)))
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            self.parsed.put(None)
+
+    def drain(self):
+        for stage_queue in [self.downloaded, self.parsed]:
+            try:
+                while True:
+                    stage_queue.get_nowait()
+            except Empty:
+                pass
+
+    def run(self):
+        """
+        Runs every stage and returns the connected TripPlanner
+        """
+        workers = [threading.Thread(target=self.download_stage, daemon=True)]
+        for i in range(self.parsers):
+            workers.append(threading.Thread(target=self.parse_stage, daemon=True))
+        for worker in workers:
+            worker.start()
+
+        try:
+            # Tracks are joined on this thread, one at a time in file order
+            finished = 0
+            waiting  = {}
+            next_seq = 0
+            while finished < self.parsers:
+                item = self.parsed.get()
+                if item is None:
+                    finished += 1
+                    continue
+                waiting[item[0]] = item[1]
+                while next_seq in waiting:
+                    track     = waiting.pop(next_seq)
+                    next_seq += 1
+                    if track and not self.errors:
+                        self.trip.add_track(track)
+        except Exception:
+            self.stop.set()
+            raise
+        finally:
+            # Unblock any stage still waiting on a full queue, and wait for it to stop
+            for worker in workers:
+                while worker.is_alive():
+                    self.drain()
+                    worker.join(0.1)
+
+        if self.errors:
+            raise self.errors[0]
+
+        print("Joined %i tracks together" % len(self.trip.tracks))
+        return self.trip
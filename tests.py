@@ -1,4 +1,10 @@
 from mapper import *
+from batch import read_jobs, check_job
+from coordstore import CoordinateStore
+from shapely.geometry import LineString
+import math
+import os
+import tempfile
 
 def test_solver(trip):
     # Setup a smaller pathway array
@@ -11,10 +17,131 @@ def test_solver(trip):
     new.get_results()
     return new
 
+def test_alternatives(trip):
+    new = RouteOptimizer(trip.trail_network, maxdist=30)
+    new.setup_lp()
+    new.set_grouping_constraint(1)
+    alternatives = new.get_alternatives(3, min_dissimilarity=0.2)
+    for i, (value, results) in enumerate(alternatives):
+        for earlier_value, earlier in alternatives[:i]:
+            # Each trip leaves out at least 20% (and at least 1) of the paths of every earlier trip
+            # A path counts as shared whichever way it is walked
+            shared  = len(set([Path.make_hash(*key) for key in results]) &
+                          set([Path.make_hash(*key) for key in earlier]))
+            dropped = max(1, math.ceil(0.2*len(earlier)))
+            assert shared <= len(earlier) - dropped
+    # The cuts are cleared, so asking again starts from the uncut best trip
+    again = new.get_alternatives(1)
+    assert again[0][0] == alternatives[0][0]
+    new.save_alternatives(Path, alternatives, "saved_trips/30km.gpx")
+    return alternatives
+
+def test_trailhead_loop():
+    # A small loop at the trailhead, joined by a bridge to a longer loop
+    # that a trip from the trailhead can't reach and come back from
+    network = nx.Graph()
+    edges   = [((0, 0), (1, 0), 1), ((1, 0), (0, 1), 1), ((0, 1), (0, 0), 1),
+               ((0, 1), (5, 5), 1),
+               ((5, 5), (6, 5), 5), ((6, 5), (5, 6), 5), ((5, 6), (5, 5), 5)]
+    for i, (origin, destination, length) in enumerate(edges):
+        network.add_edge(origin, destination, length=length, name="path_%i" % i)
+
+    new = RouteOptimizer(network, maxdist=30)
+    new.setup_lp()
+    new.set_start_node((0, 0))
+    new.set_grouping_constraint(1)
+    new.solve()
+    loop = nx.Graph([key[:2] for key in new.get_results()])
+    # One connected loop through the trailhead
+    assert (0, 0) in loop
+    assert nx.is_connected(loop)
+    assert all([degree == 2 for node, degree in loop.degree()])
+    assert new.objective.Value() == 3
+    return new
+
 def test_trips():
     trip = TripPlanner("Boulder, Colorado")
     trip.create_network()
     return trip
     
 def test_save_GPX(opt):
-    new.save_gpx(Path, "saved_trips/30km.gpx")
\ No newline at end of file
+    new.save_gpx(Path, "saved_trips/30km.gpx")
+
+def test_check_job():
+    job = check_job({"location": "Boulder, Colorado", "distance": "20", "time_limit": "60"})
+    assert "error" not in job
+    assert job["distance"] == 20 and job["triplength"] == 30 and job["time_limit"] == 60
+    assert "error" in check_job({"distance": 10})
+    assert "error" in check_job({"location": "Boulder, Colorado", "distance": "far"})
+    assert "error" in check_job(5)
+    assert "error" in check_job("abc")
+
+def test_read_jobs():
+    directory = tempfile.mkdtemp()
+    filename  = os.path.join(directory, "jobs.jsonl")
+    with open(filename, 'w') as f:
+        f.write('{"location": "Boulder, Colorado"}\n')
+        f.write('{"location": "Boulder, Colorado", "triplength": 50}\n')
+        f.write('{"location": "Moab, Utah", "name": "desert"}\n')
+        f.write('{"location": "Ouray, Colorado", "name": "desert"}\n')
+        f.write('5\n')
+        f.write('"abc"\n')
+        f.write('{"location": \n')
+        f.write('{"distance": 10}\n')
+
+    jobs = read_jobs(filename)
+    # Every line is a job, and a bad line fails on its own
+    assert len(jobs) == 8
+    assert [job["name"] for job in jobs[:3]] == ["Boulder, Colorado", "Boulder, Colorado_2", "desert"]
+    assert ["error" in job for job in jobs] == [False, False, False, True, True, True, True, True]
+    assert "Duplicate" in jobs[3]["error"]
+
+def test_coordinate_store():
+    directory = tempfile.mkdtemp()
+    # A two part track, split into a single line path and a two part path
+    track          = Track.__new__(Track)
+    track.name     = "store test"
+    track.filename = directory+"/store_test.gpx"
+    track.points   = [[(0, 0), (1, 0)], [(1, 1), (2, 1), (2, 2)]]
+    track.track    = MultiLineString(track.points)
+    track.paths    = {}
+    line  = LineString([(0, 0), (0.5, 0), (1, 0)])
+    multi = MultiLineString([[(1, 1), (2, 1)], [(2, 1), (2, 2)]])
+    for name, points, origin, destination in [("0_1_store test", line, (0, 0), (1, 0)),
+                                              ("1_2_store test", multi, (1, 1), (2, 2))]:
+        track.paths[name] = Path(name, points, origin, destination)
+
+    trip = TripPlanner(directory, load=False)
+    trip.tracks[track.name] = track
+    store = trip.compact(directory+"/.coords")
+
+    # Track rows, then each path's rows, with an offset per line and per shape
+    assert store.coords.shape == (12, 2)
+    assert list(store.lines) == [0, 2, 5, 8, 10, 12]
+    assert list(store.shapes) == [0, 2, 3, 5]
+    assert list(store.multi) == [True, False, True]
+
+    # Attached geometry is read back from the store
+    assert track.track.type == 'MultiLineString' and track.track.equals(MultiLineString(track.points))
+    assert track.paths["0_1_store test"].points.type == 'LineString'
+    assert track.paths["0_1_store test"].points.equals(line)
+    assert track.paths["1_2_store test"].points.type == 'MultiLineString'
+    assert track.paths["1_2_store test"].points.equals(multi)
+
+    # Path.coords() gives views into the mapped file, not copies
+    views = track.paths["1_2_store test"].coords()
+    assert len(views) == 2
+    assert all([np.shares_memory(view, store.coords) for view in views])
+    assert np.array_equal(views[1], np.array([(2, 1), (2, 2)]))
+
+    # A new process can open the store and rebuild the paths and network without the GPX files
+    for path in list(track.paths.values()):
+        del Path.paths[path.db_hash]
+    reopened = CoordinateStore(directory+"/.coords")
+    paths    = reopened.load_paths(Path)
+    assert [path.name for path in paths] == ["0_1_store test", "1_2_store test"]
+    assert paths[1].points.equals(multi)
+    assert paths[1].distance == track.paths["1_2_store test"].distance
+    network = reopened.network()
+    assert network.number_of_edges() == 2
+    assert network[(0, 0)][(1, 0)]["name"] == "0_1_store test"
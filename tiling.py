@@ -0,0 +1,298 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from shapely.geometry import Point
+import itertools
+import math
+import os
+
+from coordstore import CoordinateStore
+from hikingproject import HikingProject
+from mapper import TripPlanner, Path, km_to_degree
+from tripopt import RouteOptimizer
+
+
+global join_tolerance
+global scan_chunk
+join_tolerance = 0.1    # km, matches the default tolerance of Track.track_intersection
+scan_chunk     = 32     # GPX files parsed by each job when the tracks are first scanned
+
+
+def near(bounds1, bounds2, margin):
+    """
+    Whether two (minx, miny, maxx, maxy) boxes are within [margin] degrees of each other
+    """
+    return (bounds1[0] - margin <= bounds2[2] and bounds2[0] - margin <= bounds1[2] and
+            bounds1[1] - margin <= bounds2[3] and bounds2[1] - margin <= bounds1[3])
+
+
+def scan_files(filenames):
+    """
+    Parses a chunk of GPX files.  Runs in a worker process, and returns
+    only the (filename, track name, bounds) of each valid track
+    """
+    found = []
+    for filename in filenames:
+        track = TripPlanner.load_track(filename)
+        if track:
+            found.append((filename, track.name, track.track.bounds))
+    return found
+
+
+def connect_tile(tile, files, track_tiles):
+    """
+    Joins the tracks of one tile, parsed from [files], the (track name,
+    filename) of each track in the trip's order.  A pair of tracks that shows
+    up in several tiles is only joined in the first tile they share, so every
+    pair is checked once across all tiles.  Runs in a worker process, and
+    returns the (track name, track name, node) of every connection found
+    """
+    tracks      = [TripPlanner.load_track(filename) for name, filename in files]
+    connections = []
+    margin      = join_tolerance/km_to_degree
+    for line1, line2 in itertools.combinations(tracks, 2):
+        shared = set(track_tiles[line1.name]) & set(track_tiles[line2.name])
+        if min(shared) != tile:
+            continue
+        # Tracks whose bounds are further apart than the tolerance can't connect
+        if not near(line1.track.bounds, line2.track.bounds, margin):
+            continue
+        node = line1.track_intersection(line2)
+        if node:
+            connections.append((line1.name, line2.name, node))
+
+    return connections
+
+
+def setup_tile_paths(files, connections, directory):
+    """
+    Splits the tracks a tile owns into paths.  Each track in [files] is parsed
+    again and given its [connections], the (track name, node) pairs for each
+    track.  Runs in a worker process.  The tracks and paths are written to a
+    CoordinateStore in [directory] rather than sent back, and the directory is returned
+    """
+    trip = TripPlanner(directory, load=False)
+    for name, filename in files:
+        track = TripPlanner.load_track(filename)
+        for other, node in connections[name]:
+            track.connected_tracks[other] = Point(node)
+        track.setup_paths()
+        trip.tracks[name] = track
+    CoordinateStore.write(directory, trip)
+
+    # The worker is reused for other tiles, so don't keep this tile's paths
+    Path.paths.clear()
+    return directory
+
+
+def solve_tile(tile, network, mindist, maxdist, time_limit):
+    """
+    Plans the best trip within one tile's network.  Runs in a worker process
+    """
+    opt = RouteOptimizer(network, mindist=mindist, maxdist=maxdist)
+    opt.setup_lp()
+    opt.set_grouping_constraint(1)
+    opt.solve(time_limit)
+    results = opt.get_results()
+    return (opt.objective.Value(), results, tile)
+
+
+class TiledTripPlanner(TripPlanner):
+    def __init__(self, location="", tile_km=10, halo_km=0.5, workers=os.cpu_count()):
+        """
+        A TripPlanner for very large areas.  The area is split into a grid of
+        [tile_km] tiles, each taking in the tracks within [halo_km] of its
+        edges.  Tracks are joined and split into paths tile by tile on a pool
+        of [workers] processes, with only a few tiles in flight at once.  Paths
+        that meet across a tile edge share the same node, so the tiles stitch
+        into one trail_network.
+
+        Workers parse the GPX files of their own tile, and only track names,
+        bounds and connections come back, so this planner never holds the
+        tracks.  Each tile's paths are written to a CoordinateStore in a .tiles
+        folder in [location], and read from it memory-mapped.
+        """
+        if halo_km < join_tolerance:
+            raise Exception("The tile halo must be at least the %s km join tolerance" % str(join_tolerance))
+
+        TripPlanner.__init__(self, location, load=False)
+        # Like the rest of the mapper, a degree is treated as km_to_degree km either way
+        self.tile_size    = tile_km/km_to_degree
+        self.halo         = halo_km/km_to_degree
+        self.workers      = workers
+        self.tiles        = {}
+        self.grid         = None
+        self.tile_tracks  = {}
+        self.track_tiles  = {}
+        self.track_files  = {}
+        self.track_bounds = {}
+        self.connections  = {}
+        self.stores       = {}
+        self.tile_paths   = {}
+
+        self.file_list = HikingProject.get_downloaded(directory=location)
+        self.scan_tracks()
+        self.make_tiles()
+        self.connect_tracks()
+
+    def scan_tracks(self):
+        """
+        Finds the name and bounds of every track, parsing the GPX files in
+        chunks on the process pool
+        """
+        filenames = [self.location+"/"+str(gpxfile)+".gpx" for gpxfile in self.file_list]
+        chunks    = [(filenames[i:i+scan_chunk],) for i in range(0, len(filenames), scan_chunk)]
+        for found in self.run_tiles(scan_files, chunks):
+            for filename, name, bounds in found:
+                # Like load_all_tracks, a later file with the same track name replaces the earlier one
+                self.track_files[name]  = filename
+                self.track_bounds[name] = bounds
+
+        return self.track_files
+
+    def make_tiles(self):
+        """
+        Lays a grid of tiles over the tracks, and lists the tracks within
+        the halo of each tile.  Each track is put straight into the tiles its
+        bounds cover, so this grows with the number of tracks, not tiles x tracks.
+        Empty tiles are dropped
+        """
+        if not self.track_bounds:
+            return self.tiles
+
+        bounds = self.track_bounds
+        minx   = min([b[0] for b in bounds.values()])
+        miny   = min([b[1] for b in bounds.values()])
+        maxx   = max([b[2] for b in bounds.values()])
+        maxy   = max([b[3] for b in bounds.values()])
+        cols   = max(1, int(math.ceil((maxx - minx)/self.tile_size)))
+        rows   = max(1, int(math.ceil((maxy - miny)/self.tile_size)))
+        self.grid = (minx, miny, cols, rows)
+
+        for name in self.track_bounds:
+            for index in self.tile_range(bounds[name], self.halo):
+                self.tile_tracks.setdefault(index, []).append(name)
+                self.track_tiles.setdefault(name, []).append(index)
+
+        for index in sorted(self.tile_tracks):
+            row, col = divmod(index, cols)
+            self.tiles[index] = (minx + col*self.tile_size, miny + row*self.tile_size,
+                                 minx + (col+1)*self.tile_size, miny + (row+1)*self.tile_size)
+
+        print("Split %i tracks into %i tiles" % (len(self.track_bounds), len(self.tiles)))
+        return self.tiles
+
+    def tile_range(self, bounds, margin):
+        """
+        Yields the index of every grid tile within [margin] degrees of the
+        (minx, miny, maxx, maxy) [bounds], lowest index first
+        """
+        minx, miny, cols, rows = self.grid
+        clamp = lambda value, top: min(max(value, 0), top - 1)
+        col0  = clamp(int(math.floor((bounds[0] - margin - minx)/self.tile_size)), cols)
+        col1  = clamp(int(math.floor((bounds[2] + margin - minx)/self.tile_size)), cols)
+        row0  = clamp(int(math.floor((bounds[1] - margin - miny)/self.tile_size)), rows)
+        row1  = clamp(int(math.floor((bounds[3] + margin - miny)/self.tile_size)), rows)
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                yield row*cols + col
+
+    def run_tiles(self, function, jobs):
+        """
+        Runs [function] over the argument tuples in [jobs] on the process pool,
+        yielding results in the order of [jobs].  At most twice as many jobs as
+        there are workers are queued at once, so tile data is not all copied up front
+        """
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            for job in jobs:
+                if len(pending) >= self.workers*2:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(function, *job))
+
+            while pending:
+                yield pending.popleft().result()
+
+    def connect_tracks(self):
+        """
+        Joins tracks together tile by tile.  Track connectivity is established within 100 meters
+        """
+        print("Joining %i tracks together in %i tiles..." % (len(self.track_files), len(self.tiles)))
+        order = dict([(name, i) for i, name in enumerate(self.track_files)])
+
+        def jobs():
+            for tile, names in self.tile_tracks.items():
+                # Tiles list their tracks in the trip's order, so each pair is joined as TripPlanner would
+                files       = [(name, self.track_files[name]) for name in names]
+                track_tiles = dict([(name, self.track_tiles[name]) for name in names])
+                yield (tile, files, track_tiles)
+
+        # A track keeps the first node it gets within the snap tolerance, so
+        # connections from every tile are made in TripPlanner's pair order
+        connections = []
+        for tile_connections in self.run_tiles(connect_tile, jobs()):
+            connections.extend(tile_connections)
+        connections.sort(key=lambda connection: (order[connection[0]], order[connection[1]]))
+
+        for name1, name2, node in connections:
+            self.connections.setdefault(name1, []).append((name2, node))
+            self.connections.setdefault(name2, []).append((name1, node))
+
+    def create_network(self):
+        """
+        Splits tracks into paths tile by tile (each track in the first tile
+        it falls in), then builds the trail network from every tile's store
+        """
+        def jobs():
+            for tile, names in self.tile_tracks.items():
+                owned     = [name for name in names if self.track_tiles[name][0] == tile]
+                directory = os.path.join(self.location, ".tiles", str(tile))
+                if owned and directory not in self.stores:
+                    files       = [(name, self.track_files[name]) for name in owned]
+                    connections = dict([(name, self.connections.get(name, [])) for name in owned])
+                    yield (files, connections, directory)
+
+        for directory in self.run_tiles(setup_tile_paths, jobs()):
+            store = self.stores[directory] = CoordinateStore(directory)
+            for path in store.load_paths(Path):
+                self.tile_paths[path.db_hash] = path
+            self.trail_network.add_edges_from(store.network().edges(data=True))
+
+        # The network changed, so node lookups and shortest paths are stale
+        self.node_index = None
+        self.path_trees = {}
+
+    def iter_paths(self):
+        """
+        Yields every path read from the tile stores
+        """
+        for path in self.tile_paths.values():
+            yield path
+
+    def tile_networks(self):
+        """
+        Returns the part of the trail network in each tile (and its halo),
+        as a list of (tile index, network).  Each path goes straight into the
+        tiles that hold both of its ends
+        """
+        tile_edges = {}
+        for origin, destination in self.trail_network.edges():
+            origin_tiles = set(self.tile_range((origin[0], origin[1], origin[0], origin[1]), self.halo))
+            for index in self.tile_range((destination[0], destination[1], destination[0], destination[1]), self.halo):
+                if index in origin_tiles and index in self.tiles:
+                    tile_edges.setdefault(index, []).append((origin, destination))
+
+        networks = []
+        for index in sorted(tile_edges):
+            networks.append((index, self.trail_network.edge_subgraph(tile_edges[index]).copy()))
+        return networks
+
+    def solve_tiles(self, maxdist=30, mindist=0, time_limit=None):
+        """
+        Plans the best trip in each tile on its own, in parallel, rather than
+        one model across every tile.  Trips can't leave a tile's halo.
+        Returns (objective value, results, tile index) per tile, best first
+        """
+        jobs  = [(tile, network, mindist, maxdist, time_limit) for tile, network in self.tile_networks()]
+        trips = list(self.run_tiles(solve_tile, jobs))
+        trips.sort(key=lambda trip: trip[0], reverse=True)
+        return trips
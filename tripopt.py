@@ -3,6 +3,8 @@ import networkx as nx
 from shapely.geometry import Point, LineString, MultiLineString
 import gpxpy
 import os
+import errno
+import math
 
 class RouteOptimizer():
     def __init__(self, trail_network, mindist = 0, maxdist = 100):
@@ -23,8 +25,13 @@ class RouteOptimizer():
         self.solver          = None
         self.objective       = None
         self.results         = None
+        self.status          = None
         self.node_variables  = {}
         self.edge_limit      = {}
+        self.diversity_cuts  = []
+        self.active_cuts     = 0
+        self.start_node      = None
+        self.subtour_cuts    = []
         
     def set_trip_length(self, mindist, maxdist):
         self.mindist = mindist
@@ -127,8 +134,51 @@ class RouteOptimizer():
             node1.SetCoefficient(self.node_variables[pathway[0]],1)
             node2.SetCoefficient(self.node_variables[pathway[1]],1)
         
+    def set_start_node(self, node):
+        """
+        Anchors the trip at [node] (a trailhead).  It becomes the only start
+        node, the trip has to use a path that leaves from it, and as many
+        paths have to come back to it as leave it, so the trip ends there too.
+        Loops elsewhere in the network would still satisfy every node, so
+        solve() cuts out any loop that does not pass through [node]
+        """
+        if node not in self.node_variables:
+            raise Exception("The start node %s is not part of the trail network" % str(node))
+            
+        self.start_node = node
+        self.node_variables[node].SetBounds(1, 1)
+        self.edge_limit[node].SetBounds(1, 2)
+        # With the start variable at 1, out - in + 1 = 1 means out == in
+        self.constraints[node].SetBounds(1, 1)
+        
+    def add_subtour_cuts(self):
+        """
+        Finds the loops in the current solution that don't reach the start
+        node, and cuts each one out of the model: a set of n nodes without the
+        start may only use n-1 of the paths between them, so it can't close a
+        loop of its own.  The cuts hold for any trip from the start, so they
+        are kept.  Returns the number of cuts added
+        """
+        chosen = nx.Graph()
+        for key in self.variables:
+            if self.variables[key].solution_value() > 0:
+                chosen.add_edge(key[0], key[1])
+        
+        cuts = 0
+        for component in nx.connected_components(chosen):
+            if self.start_node in component:
+                continue
+            cut = self.solver.Constraint(-self.solver.infinity(), len(component) - 1)
+            for origin, destination, data in self.trail_network.subgraph(component).edges(data=True):
+                cut.SetCoefficient(self.variables[(origin, destination, data["name"])], 1)
+                cut.SetCoefficient(self.variables[(destination, origin, data["name"])], 1)
+            self.subtour_cuts.append(cut)
+            cuts += 1
+            
+        return cuts
+        
     def set_distance_constraint(self):
-        if "Distance" not in self.constraints:
+        if "Trip Distance" not in self.constraints:
             self.constraints["Trip Distance"] = self.solver.Constraint(self.mindist, self.maxdist)
         else:
             self.constraints["Trip Distance"].SetBounds(self.mindist, self.maxdist)
@@ -175,8 +225,27 @@ class RouteOptimizer():
         self.setup_variables()
         self.set_node_constraints()
         
-    def solve(self):
-        result_status = self.solver.Solve()
+    def solve(self, time_limit=None):
+        """
+        Solves the model.  [time_limit] is the solver budget in seconds;
+        the best solution found within the budget is kept.  The limit is set
+        on every solve, so a reused model doesn't keep an earlier solve's limit.
+        With a start node, the model is solved again after cutting out any
+        loop that misses the start, until the trip is one loop through it.
+        Each of those solves gets the full [time_limit]
+        """
+        if time_limit:
+            self.solver.SetTimeLimit(int(time_limit*1000))
+        else:
+            # A limit of 0 means the solver runs until it's done
+            self.solver.SetTimeLimit(0)
+        self.results  = None
+        result_status = self.status = self.solver.Solve()
+        
+        while self.start_node is not None and result_status in [pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE]:
+            if not self.add_subtour_cuts():
+                break
+            result_status = self.status = self.solver.Solve()
         return result_status
     
     def get_results(self):
@@ -190,43 +259,112 @@ class RouteOptimizer():
         self.results = results
         return results
         
-    def save_gpx(self, path_object, filename="saved_trips/temp.gpx"):
+    def add_diversity_cut(self, results, min_dissimilarity = 0.2):
         """
-        Paths is the values from .get_results() function
-        for the solved LP problem
+        Cuts the trip in [results] out of the model.  Later solutions must
+        leave out at least [min_dissimilarity] of its paths (and always at
+        least one path, so the same trip can't be found again)
         """
+        paths   = len(results)
+        dropped = max(1, int(math.ceil(min_dissimilarity*paths)))
         
-        # Need some way to order the results together
-        if not self.results:
-            self.get_results()
+        # Constraints can't be deleted from the solver, so cleared cuts are
+        # kept in a pool and reused rather than adding new rows every time
+        if self.active_cuts < len(self.diversity_cuts):
+            cut = self.diversity_cuts[self.active_cuts]
+            cut.Clear()
+            cut.SetBounds(-self.solver.infinity(), paths - dropped)
+        else:
+            cut = self.solver.Constraint(-self.solver.infinity(), paths - dropped)
+            self.diversity_cuts.append(cut)
+        self.active_cuts += 1
         
-        results = self.results
+        for key in results:
+            cut.SetCoefficient(self.variables[key], 1)
+            cut.SetCoefficient(self.variables[(key[1], key[0], key[2])], 1)
+            
+        return cut
         
-        self.make_new_gpx(filename)
-        gpx_file = open(filename, 'r')
-        gpx = gpxpy.parse(gpx_file)
-        gpx       = gpxpy.gpx.GPX()
+    def clear_diversity_cuts(self):
+        """
+        Relaxes every diversity cut, returning the model to its original trips.
+        The emptied cuts stay in the pool for the next add_diversity_cut.
+        The last solution was found with the cuts in place, so it is dropped
+        and the next get_alternatives solves the model again
+        """
+        for cut in self.diversity_cuts[:self.active_cuts]:
+            cut.Clear()
+            cut.SetBounds(-self.solver.infinity(), self.solver.infinity())
+        self.active_cuts = 0
+        self.status      = None
         
-        gpx_segment = {}
-        for path_name in results:
-            gpx_track = gpxpy.gpx.GPXTrack()
-            gpx.tracks.append(gpx_track)
-            gpx_segment[path_name] = gpxpy.gpx.GPXTrackSegment()
-            gpx_track.segments.append(gpx_segment[path_name])
+    def get_alternatives(self, k = 3, min_dissimilarity = 0.2, time_limit = None, keep_cuts = False):
+        """
+        Returns up to [k] distinct trips, best first, as a list of
+        (objective value, results).  After each solve a diversity cut is added to
+        the model that is already built, and it is solved again.  Each trip leaves
+        out at least [min_dissimilarity] of the paths of every trip before it.
+        Unless [keep_cuts], the cuts are cleared afterwards and .results is the
+        best trip; the model has to be solved again before reading its values.
+        """
+        alternatives = []
+        status       = self.status
+        if status is None:
+            status = self.solve(time_limit)
             
-            path = path_object.get(path_name).points
-            if path.type == 'LineString':
-                points = path.coords
+        while status in [pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE]:
+            results = self.get_results()
+            if not results:
+                break
+            alternatives.append((self.objective.Value(), results))
+            if len(alternatives) == k:
+                break
+            self.add_diversity_cut(results, min_dissimilarity)
+            status = self.solve(time_limit)
             
-            else:
-                points = path[0].coords
-    
-            for coord in points:
-                gpx_segment[path_name].points.append(gpxpy.gpx.GPXTrackPoint(coord[1], coord[0]))
+        if not keep_cuts:
+            self.clear_diversity_cuts()
+        if alternatives:
+            self.results = alternatives[0][1]
+            
+        return alternatives
         
-        f = open(filename, 'w+')
-        f.write(gpx.to_xml())
-        f.close()
+    def save_alternatives(self, path_object, alternatives, filename="saved_trips/temp.gpx"):
+        """
+        Saves each trip from .get_alternatives() to its own GPX file, numbered
+        after [filename] (temp_1.gpx, temp_2.gpx, ...).  Returns the filenames
+        """
+        base, ext = os.path.splitext(filename)
+        filenames = []
+        for i, (value, results) in enumerate(alternatives):
+            alt_file = "%s_%i%s" % (base, i+1, ext)
+            save_results_gpx(path_object, results, alt_file)
+            filenames.append(alt_file)
+            
+        return filenames
+        
+    def save_gpx(self, path_object, filename="saved_trips/temp.gpx"):
+        """
+        Paths is the values from .get_results() function
+        for the solved LP problem
+        """
+        
+        # Need some way to order the results together
+        save_results_gpx(path_object, self.get_trip(), filename)
+        
+    def make_gpx(self, path_object, results=None):
+        """
+        Builds a gpxpy GPX object with one track per path in [results]
+        (defaults to the .get_results() of the solved LP problem)
+        """
+        if results is None:
+            results = self.get_trip()
+        return results_gpx(path_object, results)
+        
+    def get_trip(self):
+        if not self.results:
+            self.get_results()
+        return self.results
         
     
     def make_new_gpx(self, filename = "saved_trips/output.gpx"):
@@ -248,4 +386,46 @@ class RouteOptimizer():
 
 
         
-        
\ No newline at end of file
+        
+        
+
+def results_gpx(path_object, results):
+    """
+    Builds a gpxpy GPX object with one track per path in [results] -- the
+    path keys of a solved trip.  [path_object] looks the paths up (the Path class)
+    """
+    gpx         = gpxpy.gpx.GPX()
+    gpx_segment = {}
+    for path_name in results:
+        gpx_track = gpxpy.gpx.GPXTrack()
+        gpx.tracks.append(gpx_track)
+        gpx_segment[path_name] = gpxpy.gpx.GPXTrackSegment()
+        gpx_track.segments.append(gpx_segment[path_name])
+        
+        path = path_object.get(path_name).points
+        if path.type == 'LineString':
+            points = path.coords
+        
+        else:
+            points = path[0].coords
+
+        for coord in points:
+            gpx_segment[path_name].points.append(gpxpy.gpx.GPXTrackPoint(coord[1], coord[0]))
+    
+    return gpx
+
+def save_results_gpx(path_object, results, filename="saved_trips/temp.gpx"):
+    """
+    Saves the trip in [results] to a GPX file, without needing the model
+    that found it
+    """
+    if not os.path.exists(os.path.dirname(filename)):
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError as exc: # Guard against race condition
+            if exc.errno != errno.EEXIST:
+                raise
+    
+    f = open(filename, 'w+')
+    f.write(results_gpx(path_object, results).to_xml())
+    f.close()
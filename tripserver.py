@@ -0,0 +1,305 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+import math
+import os
+import threading
+
+from hikingproject import HikingProject
+from mapper import LocationName, setup_trailhead_trip, stream_trips, km_to_degree
+from tripopt import RouteOptimizer
+
+
+global miles_to_km
+global vertex_bytes
+global mapped_bytes
+global edge_bytes
+miles_to_km  = 1.609
+vertex_bytes = 400     # A vertex is held as a python list, a shapely track and a shapely path
+mapped_bytes = 16      # A vertex in a CoordinateStore is one float64 pair, shared through the page cache
+edge_bytes   = 4000    # Graph edge, 2 solver variables and their constraint coefficients
+
+
+class Region():
+    def __init__(self, key, coords, distance, directory, session=None):
+        """
+        A warm region: the connected TripPlanner network and the RouteOptimizer
+        model built on it.  The model is kept between requests, only the trip
+        length bounds change, so a repeat query only pays for the solve.
+        """
+        self.key       = key
+        self.coords    = coords
+        self.distance  = distance
+        self.directory = directory
+        self.session   = session
+        self.trip      = None
+        self.optimizer = None
+        self.store     = None
+        self.paths     = None
+        self.size      = 0
+        self.lock      = threading.Lock()
+
+    def build(self):
+        self.trip  = stream_trips(self.coords, self.distance, self.directory, session=self.session)
+        # Keep one memory-mapped copy of the region's geometry
+        self.store = self.trip.compact()
+
+        self.optimizer = RouteOptimizer(self.trip.trail_network)
+        self.optimizer.setup_lp()
+        self.optimizer.set_grouping_constraint(1)
+        # Paths can be shared with overlapping regions, which may be released first
+        self.paths = self.trip.path_lookup()
+        self.size  = self.estimate_size()
+
+    def estimate_size(self):
+        """
+        Rough estimate of the memory held by the region, in bytes
+        """
+        edges = self.trip.trail_network.number_of_edges()*edge_bytes
+        if self.store is not None:
+            return len(self.store.coords)*mapped_bytes + edges
+
+        vertices = 0
+        for track in self.trip.tracks.values():
+            for line in track.points:
+                vertices += len(line)
+
+        return vertices*vertex_bytes + edges
+
+    def plan(self, mindist, maxdist, time_limit=None, alternatives=1, dissimilarity=0.2, trailhead=None):
+        """
+        Solves the warm model for a trip between [mindist] and [maxdist] km.
+        With [alternatives] above 1, the other distinct trips are returned too.
+        A [trailhead] (latitude, longitude) gets its own small model, built on
+        the part of the network reachable from it.
+        Solver objects are not thread safe, so each region solves one trip at a time.
+        Returns None if the region was evicted after it was handed out.
+        """
+        with self.lock:
+            if self.optimizer is None:
+                return None
+            if trailhead:
+                opt = setup_trailhead_trip(self.trip, trailhead, maxdist=maxdist, mindist=mindist)
+            else:
+                opt = self.optimizer
+                opt.set_trip_length(mindist, maxdist)
+            opt.solve(time_limit)
+            # The diversity cuts are cleared afterwards, so the next request starts uncut
+            trips = opt.get_alternatives(alternatives, dissimilarity, time_limit)
+
+            found = []
+            for value, results in trips:
+                found.append({"length":   value,
+                              "paths":    [key[2] for key in results],
+                              "gpx":      opt.make_gpx(self.paths, results).to_xml()})
+
+            if not found:
+                found.append({"length": 0, "paths": [], "gpx": opt.make_gpx(self.paths, []).to_xml()})
+
+            response = dict(found[0])
+            response["region"] = self.key
+            if alternatives > 1:
+                response["alternatives"] = found
+            return response
+
+    def release(self):
+        if self.trip:
+            self.trip.release()
+        self.trip      = None
+        self.optimizer = None
+        self.store     = None
+        self.paths     = None
+
+
+class RegionCache():
+    def __init__(self, max_bytes):
+        """
+        A least recently used cache of warm regions.  Regions are evicted
+        once the estimated memory of all cached regions exceeds [max_bytes].
+        The most recently used region is always kept.
+        """
+        self.max_bytes = max_bytes
+        self.regions   = OrderedDict()
+        self.building  = {}
+        self.lock      = threading.Lock()
+
+    def get(self, key, coords, distance, directory, session=None):
+        with self.lock:
+            if key in self.regions:
+                self.regions.move_to_end(key)
+                return self.regions[key]
+
+            # Only one thread builds a region, the others wait on its lock
+            if key not in self.building:
+                self.building[key] = Region(key, coords, distance, directory, session)
+            region = self.building[key]
+
+        with region.lock:
+            if region.optimizer is None:
+                try:
+                    region.build()
+                except:
+                    with self.lock:
+                        self.building.pop(key, None)
+                    raise
+                self.add(region)
+
+        return region
+
+    def add(self, region):
+        with self.lock:
+            self.building.pop(region.key, None)
+            self.regions[region.key] = region
+            self.regions.move_to_end(region.key)
+            evicted = self.evict()
+
+        # Waiting for a solve still running on an evicted region must not hold
+        # up the rest of the cache
+        for region in evicted:
+            with region.lock:
+                region.release()
+
+    def evict(self):
+        """
+        Takes regions out of the cache until it fits.  Called with the cache
+        lock held; the caller releases the evicted regions once it is dropped
+        """
+        evicted = []
+        while self.used() > self.max_bytes and len(self.regions) > 1:
+            key, region = self.regions.popitem(last=False)
+            print("Evicting region %s" % str(key))
+            evicted.append(region)
+        return evicted
+
+    def used(self):
+        return sum([region.size for region in self.regions.values()])
+
+    def status(self):
+        with self.lock:
+            return {"regions":    [list(key) for key in self.regions],
+                    "used_mb":    self.used()/1e6,
+                    "max_mb":     self.max_bytes/1e6}
+
+
+class TripService():
+    def __init__(self, workers=4, cache_mb=1024, directory=os.getcwd()):
+        """
+        Plans trips for JSON queries.  Each query names a region by either a
+        "location", a "lat"/"lon" pair or a "bbox" of [min_lon, min_lat, max_lon, max_lat].
+        """
+        self.directory = directory
+        self.cache     = RegionCache(cache_mb*1e6)
+        self.pool      = ThreadPoolExecutor(max_workers=workers)
+        self.locations = {}
+        self.session   = None
+        self.login     = threading.Lock()
+
+    def region_for(self, query):
+        """
+        Returns the coordinates, search distance (miles) and folder for a query.
+        The planner loads every file in a folder, so each distance gets its own
+        """
+        distance = query.get("distance", 10)
+        if "bbox" in query:
+            min_lon, min_lat, max_lon, max_lat = query["bbox"]
+            coords   = ((min_lat + max_lat)/2, (min_lon + max_lon)/2)
+            # Half the bbox diagonal, so the search radius covers the corners
+            diagonal = math.hypot((max_lat - min_lat), (max_lon - min_lon)*math.cos(math.radians(coords[0])))
+            distance = int(math.ceil(diagonal/2*km_to_degree/miles_to_km))
+            name     = "%.4f_%.4f_%.4f_%.4f" % (min_lon, min_lat, max_lon, max_lat)
+        elif "location" in query:
+            name = query["location"]
+            if name not in self.locations:
+                self.locations[name] = LocationName(name)
+            coords = self.locations[name]
+        elif "lat" in query and "lon" in query:
+            coords = (float(query["lat"]), float(query["lon"]))
+            name   = "%.4f_%.4f" % coords
+        else:
+            raise Exception("A query needs a location, lat and lon, or bbox")
+
+        distance = int(distance)
+        return (coords, distance, os.path.join(self.directory, name, "%imi" % distance))
+
+    def get_session(self):
+        """
+        Logs in to HikingProject once, and shares the session across region builds
+        """
+        with self.login:
+            if self.session is None:
+                self.session = HikingProject.open_session()
+        return self.session
+
+    def plan(self, query):
+        coords, distance, folder = self.region_for(query)
+        key = (round(coords[0], 4), round(coords[1], 4), distance)
+        while True:
+            region = self.cache.get(key, coords, distance, folder, self.get_session())
+            result = region.plan(query.get("mindist", 0),
+                                 query.get("maxdist", 30),
+                                 query.get("time_limit"),
+                                 int(query.get("alternatives", 1)),
+                                 query.get("dissimilarity", 0.2),
+                                 query.get("trailhead"))
+            # An evicted region is built again through the cache
+            if result is not None:
+                return result
+
+    def submit(self, query):
+        return self.pool.submit(self.plan, query)
+
+
+class TripRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.respond(200, self.service.cache.status())
+        else:
+            self.respond(404, {"error": "Unknown endpoint %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/trip":
+            self.respond(404, {"error": "Unknown endpoint %s" % self.path})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            query  = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.respond(400, {"error": "The request body is not valid JSON"})
+            return
+
+        try:
+            result = self.service.submit(query).result()
+        except Exception as e:
+            self.respond(500, {"error": str(e)})
+            return
+
+        self.respond(200, result)
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port=8080, workers=4, cache_mb=1024):
+    """
+    Runs the trip planning service until interrupted.
+
+    POST /trip   {"location": "Boulder, Colorado", "distance": 10, "maxdist": 30, "time_limit": 60}
+    GET  /status
+    """
+    TripRequestHandler.service = TripService(workers=workers, cache_mb=cache_mb)
+    server = ThreadingHTTPServer(("", port), TripRequestHandler)
+    print("Trip planner listening on port %i" % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()